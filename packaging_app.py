@@ -1,88 +1,201 @@
 import json, os
+import numpy as np
 import streamlit as st
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
-# ---- Force Streamlit to clear old cached layouts ----
-st.cache_data.clear()
-
 # ---- Load database ----
+DB_FILE = "data.json"
+
+# The file's mtime (an int in ns) is the database version: edits to
+# data.json bump it, and every cache below is keyed on it instead of
+# hashing the database itself
+@st.cache_resource(max_entries=1)
+def read_database(db_version):
+    with open(DB_FILE, "r") as f:
+        return json.load(f)
+
 def load_database():
     try:
-        with open("data.json", "r") as f:
-            return json.load(f)
+        db_version = os.stat(DB_FILE).st_mtime_ns
+        return read_database(db_version), db_version
     except Exception as e:
         st.error(f"❌ Could not load data.json — {e}")
-        return {}
+        return {}, None
+
+# ---- Rule index: (parameter, value) -> names of the rules it triggers ----
+# Derived tables below keep only the current db_version, like read_database
+@st.cache_data(max_entries=1)
+def build_rule_index(_rules, db_version):
+    index = {}
+    for rule_name, rule in _rules.items():
+        for trigger in rule.get("triggers", []):
+            for key, value in trigger.items():
+                index.setdefault((key, value), []).append(rule_name)
+    return index
+
+# ---- Material corpus (parallel name/document lists) ----
+def fields_text(fields):
+    words = []
+    for value in fields.values():
+        if isinstance(value, str):
+            words.append(value)
+        elif isinstance(value, list):
+            words.extend(v for v in value if isinstance(v, str))
+    return " ".join(words)
 
-db = load_database()
+@st.cache_data(max_entries=1)
+def build_material_corpus(_materials, db_version):
+    names = list(_materials.keys())
+    docs = [
+        _materials[m].get("material_type", "") + " "
+        + fields_text(_materials[m].get("characteristics", {}))
+        for m in names
+    ]
+    return names, docs
+
+# ---- Material display cards ----
+# Sustainability flags packed as recyclable | pcr_available << 1 | biodegradable << 2,
+# with the display label for each of the 8 masks built once
+SUSTAINABILITY_LABELS = tuple(
+    ", ".join(
+        label for bit, label in enumerate(("Recyclable", "PCR available", "Biodegradable"))
+        if mask >> bit & 1
+    ) or "None"
+    for mask in range(8)
+)
+
+@st.cache_data(max_entries=1)
+def build_material_cards(_materials, db_version):
+    cards = {}
+    for m, info in _materials.items():
+        chars = info.get("characteristics", {})
+        sustainability = info.get("sustainability", {})
+        mask = (
+            bool(sustainability.get("recyclable"))
+            | bool(sustainability.get("pcr_available")) << 1
+            | bool(sustainability.get("biodegradable")) << 2
+        )
+        cards[m] = {
+            "Material": m.replace("_", " "),
+            "Type": info.get("material_type", "N/A"),
+            "Barriers": (
+                f"Oxygen: {chars.get('oxygen_barrier', 'N/A')}, "
+                f"Moisture: {chars.get('moisture_barrier', 'N/A')}, "
+                f"Light: {chars.get('light_barrier', 'N/A')}"
+            ),
+            "Sustainability": SUSTAINABILITY_LABELS[mask],
+            "Cost": chars.get("cost_category", "N/A"),
+        }
+    return cards
 
 # ---- Recommendation logic ----
-def recommend_materials(product_name, db):
-    products = db.get("products", {})
-    materials = db.get("packaging_materials", {})
-    rules = db.get("recommendation_rules", {})
+# Bounded, and only ever called with names that exist in the database
+@st.cache_data(max_entries=256)
+def recommend_materials(product_name, _db, db_version):
+    products = _db.get("products", {})
+    materials = _db.get("packaging_materials", {})
+    rules = _db.get("recommendation_rules", {})
 
     if product_name not in products:
         return []
 
-    product_desc = products[product_name].get("description", "")
-    matched_materials = []
+    params = products[product_name].get("auto_parameters", {})
+
+    # Rule-based: one index hit per product parameter
+    rule_index = build_rule_index(rules, db_version)
+    triggered = set()
+    for key, value in params.items():
+        if isinstance(value, str):
+            triggered.update(rule_index.get((key, value), ()))
 
-    # Rule-based
-    for rule in rules.values():
-        trig = rule.get("trigger", "").lower()
-        if trig and (trig in product_name.lower() or trig in product_desc.lower()):
-            matched_materials.extend(rule.get("materials", []))
+    # Recommending rules add their priority, avoiding rules subtract it
+    scores = {}
+    for rule_name, rule in rules.items():
+        if rule_name in triggered:
+            priority = rule.get("priority_score", 1)
+            for m in rule.get("recommended_materials", []):
+                scores[m] = scores.get(m, 0) + priority
+            for m in rule.get("avoid_materials", []):
+                scores[m] = scores.get(m, 0) - priority
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    matched_materials = [m for m, score in ranked if score > 0]
 
     # TF-IDF fallback
     if not matched_materials and materials:
-        mat_names = list(materials.keys())
-        mat_descs = [materials[m].get("description", "") for m in mat_names]
+        mat_names, mat_docs = build_material_corpus(materials, db_version)
         vectorizer = TfidfVectorizer()
-        tfidf = vectorizer.fit_transform([product_desc] + mat_descs)
+        try:
+            tfidf = vectorizer.fit_transform([fields_text(params)] + mat_docs)
+        except ValueError:
+            # Empty vocabulary: nothing to compare on
+            return []
         sims = cosine_similarity(tfidf[0:1], tfidf[1:]).flatten()
-        top = sims.argsort()[-3:][::-1]
+        # Partial selection: only materials at or above the 3rd-best similarity
+        k = min(3, len(sims))
+        kth = np.partition(sims, len(sims) - k)[len(sims) - k]
+        candidates = np.flatnonzero(sims >= kth)
+        # Best first; equal similarities go to the later material
+        top = candidates[np.lexsort((-candidates, -sims[candidates]))][:k]
         matched_materials = [mat_names[i] for i in top]
 
+    cards = build_material_cards(materials, db_version)
     recs = []
     for m in matched_materials:
-        if m in materials:
-            info = materials[m]
-            recs.append({
-                "Material": m,
-                "Description": info.get("description", "N/A"),
-                "Cost": info.get("cost", "N/A"),
-                "Barrier Strength": info.get("barrier_strength", "N/A"),
-                "Sustainability": info.get("sustainability", "N/A"),
-            })
+        card = cards.get(m)
+        if card is not None:
+            recs.append(card)
     return recs
 
 # ---- Streamlit UI ----
+HEADER_HTML = (
+    "<h1 style='text-align:center;'>🤖 Packaging Advisory Chat</h1>"
+    "<p style='text-align:center;'>Type your product name below and get instant packaging recommendations.</p>"
+)
+
 st.set_page_config(page_title="Packaging Chat", page_icon="📦", layout="centered")
+db, db_version = load_database()
 
-st.markdown("<h1 style='text-align:center;'>🤖 Packaging Advisory Chat</h1>", unsafe_allow_html=True)
-st.markdown("<p style='text-align:center;'>Type your product name below and get instant packaging recommendations.</p>", unsafe_allow_html=True)
+st.markdown(HEADER_HTML, unsafe_allow_html=True)
 
-# Single input only
-product_name = st.text_input("💬 What is your product name?", placeholder="e.g., Milk, Shampoo, Chips...")
+# ---- Chat panel (reruns on its own, without the page header) ----
+@st.fragment
+def chat_panel(db, db_version):
+    # Single input only; the form holds reruns until submit
+    with st.form("product_form"):
+        product_name = st.text_input("💬 What is your product name?", placeholder="e.g., Milk, Shampoo, Chips...")
+        submitted = st.form_submit_button("Get Recommendations 🚀", use_container_width=True)
 
-if st.button("Get Recommendations 🚀", use_container_width=True):
-    if not product_name.strip():
-        st.warning("Please enter a product name.")
-    else:
-        recs = recommend_materials(product_name.strip(), db)
-        if not recs:
-            st.info("No matches found. Try a different name or check data.json.")
+    if submitted:
+        if not product_name.strip():
+            st.warning("Please enter a product name.")
         else:
-            st.success(f"Top Packaging Recommendations for **{product_name}**:")
-            for r in recs:
-                with st.container():
-                    st.markdown(f"### 🧱 {r['Material']}")
-                    st.write(f"**Description:** {r['Description']}")
-                    st.write(f"**Barrier Strength:** {r['Barrier Strength']}")
-                    st.write(f"**Sustainability:** {r['Sustainability']}")
-                    st.write(f"**Cost:** {r['Cost']}")
-                    st.markdown("---")
+            name = product_name.strip()
+            # Unknown names never reach the shared cache
+            if name in db.get("products", {}):
+                try:
+                    recs = recommend_materials(name, db, db_version)
+                except Exception as e:
+                    # Failures are never cached, so a fixed data.json is retried
+                    st.error(f"❌ Could not build recommendations — {e}")
+                    return
+            else:
+                recs = []
+            if not recs:
+                st.info("No matches found. Try a different name or check data.json.")
+            else:
+                st.success(f"Top Packaging Recommendations for **{product_name}**:")
+                # All cards go out as one markdown element
+                st.markdown("".join(
+                    f"### 🧱 {r['Material']}\n\n"
+                    f"**Type:** {r['Type']}\n\n"
+                    f"**Barriers:** {r['Barriers']}\n\n"
+                    f"**Sustainability:** {r['Sustainability']}\n\n"
+                    f"**Cost:** {r['Cost']}\n\n"
+                    "---\n\n"
+                    for r in recs
+                ))
+
+chat_panel(db, db_version)
 
 st.caption("💡 Uses your existing `data.json`. No API key required.")